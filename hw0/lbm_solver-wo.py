@@ -10,9 +10,23 @@ import numpy as np
 import matplotlib
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
+try:
+    import numba # optional: host-side vorticity for solve(vor_backend='numba')
+except ImportError:
+    numba = None
 
 ti.init(arch=ti.gpu)
 
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def compute_vor(vel, out):
+        # vor = dv/dx - du/dy, central difference on interior cells
+        nx, ny = out.shape
+        for i in numba.prange(1, nx - 1):
+            for j in range(1, ny - 1):
+                out[i, j] = 0.5 * (vel[i + 1, j, 1] - vel[i - 1, j, 1]) \
+                          - 0.5 * (vel[i, j + 1, 0] - vel[i, j - 1, 0])
+
 @ti.data_oriented
 class lbm_solver:
     def __init__(self,
@@ -32,193 +46,286 @@ class lbm_solver:
         self.tau = 3.0 * niu + 0.5
         self.inv_tau = 1.0 / self.tau
         self.steps = steps
-        self.w = ti.var(dt=ti.f32, shape=9)   
-        self.e = ti.var(dt=ti.i32, shape=(9, 2))
-        self.bc_type = ti.var(dt=ti.i32, shape=4)
-        self.bc_value = ti.var(dt=ti.f32, shape=(4, 2))
+        # lattice weights and velocities are Python constants, folded into every kernel
+        self.w = (
+            4.0 /  9.0, 1.0 /  9.0, 1.0 /  9.0, 
+            1.0 /  9.0, 1.0 /  9.0, 1.0 / 36.0,
+            1.0 / 36.0, 1.0 / 36.0, 1.0 / 36.0
+        )
+        self.e = (
+            ( 0, 0), ( 1,  0), (0,  1), 
+            (-1, 0), ( 0, -1), (1,  1),
+            (-1, 1), (-1, -1), (1, -1)
+        )
+        self.ex = tuple(c[0] for c in self.e)
+        self.ey = tuple(c[1] for c in self.e)
+        self.bc_type = tuple(bc_type) # fixed per run, resolved at compile time
+        self.bc_value = tuple((float(u), float(v)) for u, v in bc_value) # likewise
         self.cy = cy
         self.cy_para = ti.var(dt=ti.f32, shape=3)
+
+        ## 颜色映射
+        colors = [
+            (1, 1, 0), 
+            (0.953, 0.490, 0.016), 
+            (0, 0, 0),
+            (0.176, 0.976, 0.529), 
+            (0, 1, 1)
+        ]
+        self._my_cmap = matplotlib.colors.LinearSegmentedColormap.from_list(
+            'my_cmap', colors)
+        self._vor_norm = matplotlib.colors.Normalize(vmin=-0.02, vmax=0.02)
+        self._vel_cmap = cm.plasma
         
         ## 预分配变量
-        self.rho = ti.var(dt=ti.f32, shape=(nx, ny))
-        self.vel = ti.Vector(2, dt=ti.f32, shape=(nx, ny))
-        self.mask = ti.var(dt=ti.f32, shape=(nx, ny))
-        self.f_old = ti.Vector(9, dt=ti.f32, shape=(nx, ny))
-        self.f_new = ti.Vector(9, dt=ti.f32, shape=(nx, ny))
-        self.display_var = ti.var(dt=ti.f32, shape=(nx, ny))
+        self.rho = ti.var(dt=ti.f32)
+        self.vel = ti.Vector(2, dt=ti.f32)
+        self.f_old = ti.var(dt=ti.f32)
+        self.f_new = ti.var(dt=ti.f32)
+        # fields read by the 3x3 stencil live in B x B tiles (padded to a multiple of B)
+        B = 8
+        nbx, nby = (nx + B - 1) // B, (ny + B - 1) // B
+        ti.root.dense(ti.ij, (nbx, nby)).dense(ti.ij, (B, B)).place(
+            self.rho, self.vel)
+        # SoA: direction k is the outermost index, f[k, i, j]
+        for f in (self.f_old, self.f_new):
+            ti.root.dense(ti.ijk, (9, nbx, nby)).dense(ti.ijk, (1, B, B)).place(f)
+        # uint8 RGBA frame coloured on the device: [:, :ny] vorticity, [:, ny:] |vel|
+        self.img = ti.var(dt=ti.u8, shape=(nx, ny * 2, 4))
+        # one row per colormap entry (each cmap's own N), row N holds the NaN ("bad") colour
+        self.vor_lut_n = self._my_cmap.N
+        self.vel_lut_n = self._vel_cmap.N
+        self.vor_lut = ti.var(dt=ti.u8, shape=(self.vor_lut_n + 1, 4))
+        self.vel_lut = ti.var(dt=ti.u8, shape=(self.vel_lut_n + 1, 4))
+        # (i, j) of every cell inside the cylinder, so the obstacle bc skips fluid cells
+        solid = np.zeros((0, 2), dtype=np.int32)
+        if (cy == 1):
+            ii, jj = np.meshgrid(np.arange(nx, dtype=np.float32),
+                                 np.arange(ny, dtype=np.float32), indexing='ij')
+            xc, yc, r = np.array(cy_para, dtype=np.float32)
+            solid = np.argwhere((ii - xc)**2 + (jj - yc)**2 <= r**2).astype(np.int32)
+        self.nsolid = len(solid)
+        self.solid = ti.Vector(2, dt=ti.i32, shape=max(self.nsolid, 1))
 
         ## 赋值
-        arr = np.array([ 
-            4.0 /  9.0, 1.0 /  9.0, 1.0 /  9.0, 
-            1.0 /  9.0, 1.0 /  9.0, 1.0 / 36.0,
-            1.0 / 36.0, 1.0 / 36.0, 1.0 / 36.0
-        ], dtype=np.float32)
-        self.w.from_numpy(arr)
-        arr = np.array([
-            [ 0, 0], [ 1,  0], [0,  1], 
-            [-1, 0], [ 0, -1], [1,  1],
-            [-1, 1], [-1, -1], [1, -1]
-        ], dtype=np.int32)
-        self.e.from_numpy(arr)
-        self.bc_type.from_numpy(np.array(bc_type, dtype=np.int32))
-        self.bc_value.from_numpy(np.array(bc_value, dtype=np.float32))
         self.cy_para.from_numpy(np.array(cy_para, dtype=np.float32))
+        if (self.nsolid > 0):
+            self.solid.from_numpy(solid)
+
+        # integer input indexes the colormap table directly: the exact rows matplotlib uses,
+        # followed by the colour matplotlib draws for NaN
+        def build_lut(cmap):
+            return np.vstack((cmap(np.arange(cmap.N), bytes=True),
+                              np.array(cmap(np.nan, bytes=True), dtype=np.uint8)))
+        self.vor_lut.from_numpy(build_lut(self._my_cmap))
+        self.vel_lut.from_numpy(build_lut(self._vel_cmap))
+        self._vor = np.zeros((nx, ny), dtype=np.float32) # only for vor_backend='numba'
 
 
     @ti.func # compute equilibrium distribution function
-    def f_eq(self, i, j, k):
-        e, vel, w, rho = ti.static(self.e, self.vel, self.w, self.rho)
-        eu = e[k, 0] * vel[i, j][0] + e[k, 1] * vel[i, j][1]
-        uv = vel[i, j][0]**2.0 + vel[i, j][1]**2.0
-        return w[k] * rho[i, j] * (1.0 + 3.0 * eu + 4.5 * eu**2 - 1.5 * uv)
+    def f_eq(self, i, j, k: ti.template()):
+        vx = self.vel[i, j][0]
+        vy = self.vel[i, j][1]
+        return self.f_eq_local(k, self.rho[i, j], vx, vy, vx * vx + vy * vy)
+
+    @ti.func # f_eq from rho u v already in registers; uv = u*u + v*v is shared by all k
+    def f_eq_local(self, k: ti.template(), rho, vx, vy, uv):
+        e, w = ti.static(self.e, self.w)
+        eu = e[k][0] * vx + e[k][1] * vy
+        return w[k] * rho * (1.0 + 3.0 * eu + 4.5 * eu * eu - 1.5 * uv)
 
     @ti.kernel
     def init(self):
-        for i, j in self.rho:
+        for i, j in ti.ndrange(self.nx, self.ny):
             self.vel[i, j][0] = 0.0
             self.vel[i, j][1] = 0.0
             self.rho[i, j] = 1.0
-            self.mask[i, j] = 0.0
             for k in ti.static(range(9)):
-                self.f_new[i, j][k] = self.f_eq(i, j, k)
-                self.f_old[i, j][k] = self.f_new[i, j][k]
-            if(self.cy==1):
-                if ((i - self.cy_para[0])**2.0 + (j - self.cy_para[1])**2.0 
-                    <= self.cy_para[2]**2.0):
-                    self.mask[i, j] = 1.0
-
+                # seed both ping-pong buffers with the same equilibrium
+                feq = self.f_eq(i, j, k)
+                self.f_old[k, i, j] = feq
+                self.f_new[k, i, j] = feq
 
-    @ti.kernel
-    def collide_and_stream(self): # lbm core equation
-        for i, j in ti.ndrange((1, self.nx - 1), (1, self.ny - 1)):
-            for k in ti.static(range(9)):
-                ip = i - self.e[k, 0]
-                jp = j - self.e[k, 1]
-                self.f_new[i,j][k] = (1.0-self.inv_tau)*self.f_old[ip,jp][k] + \
-                                        self.f_eq(ip,jp,k)*self.inv_tau
 
     @ti.kernel
-    def update_macro_var(self): # compute rho u v
+    def substep(self, f_src: ti.template(), f_dst: ti.template()): # one full lbm step
+        # every stage is its own top-level loop, so each stays parallel and they run
+        # in order, but the whole step costs a single kernel launch
         for i, j in ti.ndrange((1, self.nx - 1), (1, self.ny - 1)):
-            self.rho[i, j] = 0.0
-            self.vel[i, j][0] = 0.0
-            self.vel[i, j][1] = 0.0
-            for k in ti.static(range(9)):
-                self.f_old[i, j][k] = self.f_new[i, j][k]
-                self.rho[i, j] += self.f_new[i, j][k]
-                self.vel[i, j][0] += (self.e[k, 0] * self.f_new[i, j][k])
-                self.vel[i, j][1] += (self.e[k, 1] * self.f_new[i, j][k])
-            self.vel[i, j][0] /= self.rho[i, j]
-            self.vel[i, j][1] /= self.rho[i, j]
+            self.stream_collide(f_src, f_dst, i, j)
 
-    @ti.kernel
-    def apply_bc(self): # impose boundary conditions
+        # impose boundary conditions
         # left and right
         for j in ti.ndrange(1, self.ny - 1):
             # left: dr = 0; ibc = 0; jbc = j; inb = 1; jnb = j
-            self.apply_bc_core(1, 0, 0, j, 1, j)
+            self.apply_bc_outer(f_dst, 0, 0, j, 1, j)
 
             # right: dr = 2; ibc = nx-1; jbc = j; inb = nx-2; jnb = j
-            self.apply_bc_core(1, 2, self.nx - 1, j, self.nx - 2, j)
+            self.apply_bc_outer(f_dst, 2, self.nx - 1, j, self.nx - 2, j)
 
         # top and bottom
         for i in ti.ndrange(self.nx):
             # top: dr = 1; ibc = i; jbc = ny-1; inb = i; jnb = ny-2
-            self.apply_bc_core(1, 1, i, self.ny - 1, i, self.ny - 2)
+            self.apply_bc_outer(f_dst, 1, i, self.ny - 1, i, self.ny - 2)
 
             # bottom: dr = 3; ibc = i; jbc = 0; inb = i; jnb = 1
-            self.apply_bc_core(1, 3, i, 0, i, 1)
-
-        # cylindrical obstacle
-        # Note: for cuda backend, putting 'if statement' inside loops can be much faster!
-        for i, j in ti.ndrange(self.nx, self.ny): 
-            if (self.cy == 1 and self.mask[i, j] == 1):
-                self.vel[i, j][0] = 0.0  # velocity is zero at solid boundary  
-                self.vel[i, j][1] = 0.0
-                inb = 0
-                jnb = 0
-                if (i >= self.cy_para[0]):
-                    inb = i + 1
-                else:
-                    inb = i - 1
-                if (j >= self.cy_para[1]):
-                    jnb = j + 1
-                else:
-                    jnb = j - 1
-                self.apply_bc_core(0, 0, i, j, inb, jnb)
+            self.apply_bc_outer(f_dst, 3, i, 0, i, 1)
+
+        # cylindrical obstacle, only compiled in if cy == 1
+        if ti.static(self.cy == 1):
+            for s in range(self.nsolid):
+                self.apply_bc_cyl(f_dst, s)
 
     @ti.func
-    def apply_bc_core(self, outer, dr, ibc, jbc, inb, jnb):
-        if (outer == 1):  # handle outer boundary
-            if (self.bc_type[dr] == 0):
-                self.vel[ibc, jbc][0] = self.bc_value[dr, 0]
-                self.vel[ibc, jbc][1] = self.bc_value[dr, 1]
-            elif (self.bc_type[dr] == 1):
-                self.vel[ibc, jbc][0] = self.vel[inb, jnb][0]
-                self.vel[ibc, jbc][1] = self.vel[inb, jnb][1]
+    def stream_collide(self, f_src: ti.template(), f_dst: ti.template(), i, j): # lbm core equation
+        # f_src/f_dst hold post-collision distributions; one pass per cell does
+        # pull streaming, computes rho u v and collides into f_dst
+        e = ti.static(self.e)
+        # all 9 directions as one lane-wise vector expression; w, ex, ey are literals
+        w = ti.Vector(self.w)
+        ex = ti.Vector(self.ex)
+        ey = ti.Vector(self.ey)
+        f = ti.Vector.zero(ti.f32, 9)
+        for k in ti.static(range(9)):
+            f[k] = f_src[k, i - e[k][0], j - e[k][1]]
+        rho = f.sum()
+        vx = ex.dot(f) / rho
+        vy = ey.dot(f) / rho
+        uv = vx * vx + vy * vy
+        eu = ex * vx + ey * vy
+        feq = w * rho * (1.0 + 3.0 * eu + 4.5 * eu * eu - 1.5 * uv)
+        f = (1.0 - self.inv_tau) * f + self.inv_tau * feq
+        self.rho[i, j] = rho
+        self.vel[i, j][0] = vx
+        self.vel[i, j][1] = vy
+        for k in ti.static(range(9)):
+            f_dst[k, i, j] = f[k]
+
+    @ti.func
+    def apply_bc_cyl(self, f: ti.template(), s): # s-th solid cell of the cylinder
+        i = self.solid[s][0]
+        j = self.solid[s][1]
+        inb = 0
+        jnb = 0
+        if (i >= self.cy_para[0]):
+            inb = i + 1
+        else:
+            inb = i - 1
+        if (j >= self.cy_para[1]):
+            jnb = j + 1
+        else:
+            jnb = j - 1
+        self.apply_bc_core(f, i, j, inb, jnb, 0.0, 0.0)  # velocity is zero at solid boundary
+
+    @ti.func
+    def apply_bc_outer(self, f: ti.template(), dr: ti.template(), ibc, jbc, inb, jnb):
+        # bc_type[dr] is a Python constant, so only one branch gets compiled
+        if ti.static(self.bc_type[dr] == 0):
+            self.apply_bc_outer_dirichlet(f, dr, ibc, jbc, inb, jnb)
+        else:
+            self.apply_bc_outer_neumann(f, ibc, jbc, inb, jnb)
+
+    @ti.func
+    def apply_bc_outer_dirichlet(self, f: ti.template(), dr: ti.template(), ibc, jbc, inb, jnb):
+        # bc_value[dr] is baked into the kernel as a literal, no field load
+        u = ti.static(self.bc_value[dr])
+        self.apply_bc_core(f, ibc, jbc, inb, jnb, u[0], u[1])
+
+    @ti.func
+    def apply_bc_outer_neumann(self, f: ti.template(), ibc, jbc, inb, jnb):
+        # rho u v are copied from the neighbour, so f_eq(bc) == f_eq(nb) and the
+        # non-equilibrium extrapolation reduces to copying f
         self.rho[ibc, jbc] = self.rho[inb, jnb]
+        self.vel[ibc, jbc][0] = self.vel[inb, jnb][0]
+        self.vel[ibc, jbc][1] = self.vel[inb, jnb][1]
         for k in ti.static(range(9)):
-            self.f_old[ibc,jbc][k] = self.f_eq(ibc,jbc,k) \
-                                    - self.f_eq(inb,jnb,k) \
-                                    + self.f_old[inb,jnb][k]
+            f[k,ibc,jbc] = f[k,inb,jnb]
 
-    @ti.kernel
-    def get_display_var(self):
-        # get velocity magnitude
-        for i, j in ti.ndrange(self.nx, self.ny):
-            self.display_var[i, j] = ti.sqrt(self.vel[i, j][0]**2.0 +
-                                             self.vel[i, j][1]**2.0)
+    @ti.func
+    def apply_bc_core(self, f: ti.template(), ibc, jbc, inb, jnb, vx_bc, vy_bc):
+        # f(bc) = f_eq(bc) - f_eq(nb) + f(nb); rho u v of nb are loaded once
+        rho = self.rho[inb, jnb]
+        vx = self.vel[inb, jnb][0]
+        vy = self.vel[inb, jnb][1]
+        uv = vx * vx + vy * vy
+        uv_bc = vx_bc * vx_bc + vy_bc * vy_bc
+        self.rho[ibc, jbc] = rho
+        self.vel[ibc, jbc][0] = vx_bc
+        self.vel[ibc, jbc][1] = vy_bc
+        for k in ti.static(range(9)):
+            f[k,ibc,jbc] = self.f_eq_local(k, rho, vx_bc, vy_bc, uv_bc) \
+                           - self.f_eq_local(k, rho, vx, vy, uv) \
+                           + f[k,inb,jnb]
 
     @ti.kernel
-    def get_display_var_x(self):
-        # get x-direction component only
+    def get_display_var(self, with_vor: ti.template()):
+        # velocity magnitude, scaled to [0, 1] for the plasma colormap
         for i, j in ti.ndrange(self.nx, self.ny):
-            self.display_var[i, j] = self.vel[i, j][0]
+            vel_mag = ti.sqrt(self.vel[i, j][0]**2.0 + self.vel[i, j][1]**2.0) / 0.15
+            self.colorize(self.vel_lut, self.vel_lut_n, i, j + self.ny, vel_mag)
+
+        # vor = dv/dx - du/dy, central difference on interior cells (0 on the border)
+        if ti.static(with_vor):
+            vmin, vmax = ti.static(self._vor_norm.vmin, self._vor_norm.vmax)
+            for i, j in ti.ndrange(self.nx, self.ny):
+                vor = 0.0
+                if (i > 0 and i < self.nx - 1 and j > 0 and j < self.ny - 1):
+                    vor = 0.5 * (self.vel[i + 1, j][1] - self.vel[i - 1, j][1]) \
+                        - 0.5 * (self.vel[i, j + 1][0] - self.vel[i, j - 1][0])
+                self.colorize(self.vor_lut, self.vor_lut_n, i, j, (vor - vmin) / (vmax - vmin))
 
-    def solve(self):
+    @ti.func
+    def colorize(self, lut: ti.template(), n: ti.template(), i, j, x):
+        # same binning as matplotlib: x is clipped to [0, 1] in float before the cast, so
+        # +-inf and huge values land on the end rows; NaN (detected on the bit pattern,
+        # which fast math cannot fold away) takes the "bad" row n
+        idx = n
+        if (ti.bit_cast(ti.cast(x, ti.f32), ti.i32) & 0x7fffffff) <= 0x7f800000:
+            xc = ti.min(ti.max(x, 0.0), 1.0)
+            idx = ti.min(ti.cast(xc * n, ti.i32), n - 1)
+        for c in ti.static(range(4)):
+            self.img[i, j, c] = lut[idx, c]
+
+    def solve(self,
+        render_every: ti.i32 = 50, # render one frame every `render_every` steps
+        vor_backend = 'taichi' # 'taichi' -> in the display kernel ; 'numba' -> on the host
+    ):
+        if (render_every < 1):
+            raise ValueError(f'render_every must be >= 1, got {render_every}')
+        if (vor_backend not in ('taichi', 'numba')):
+            raise ValueError(f"vor_backend must be 'taichi' or 'numba', got {vor_backend!r}")
+        if (vor_backend == 'numba' and numba is None):
+            raise ImportError("vor_backend='numba' requires numba to be installed")
         gui = ti.GUI('lbm solver', (self.nx, self.ny*2))
         self.init()
         for i in range(self.steps):
-            self.collide_and_stream()
-            self.update_macro_var()
-            self.apply_bc()
-            self.get_display_var()
-
-            ## vor
-            vel = self.vel.to_numpy()
-            ugrad = np.gradient(vel[:, :, 0])
-            vgrad = np.gradient(vel[:, :, 1])
-            du_dy = ugrad[1]
-            dv_dx = vgrad[0]
-            ## vor = dv/dx - du/dy
-            vor = dv_dx - du_dy
-            ## 颜色映射
-            colors = [
-                (1, 1, 0), 
-                (0.953, 0.490, 0.016), 
-                (0, 0, 0),
-                (0.176, 0.976, 0.529), 
-                (0, 1, 1)
-            ]
-            my_cmap = matplotlib.colors.LinearSegmentedColormap.from_list(
-                'my_cmap', colors)
-            vor_img = cm.ScalarMappable(cmap=my_cmap).to_rgba(vor)
-            vel_img = cm.plasma(self.display_var.to_numpy() / 0.15)
-    
-            # numpy 的 y 方向貌似和 taichi 相反
-            img = np.concatenate((vor_img, vel_img), axis=1)
-            gui.set_image(img)
-            
-            # gui.show()
-            gui.show(f'frame/{i:04d}.png')
+            self.substep(self.f_old, self.f_new)
+            # ping-pong: the buffer just written becomes the source of the next step
+            self.f_old, self.f_new = self.f_new, self.f_old
+
+            if (i % render_every == 0):
+                # numpy 的 y 方向貌似和 taichi 相反
+                self.get_display_var(vor_backend == 'taichi')
+                img = self.img.to_numpy()
+                if (vor_backend == 'numba'):
+                    compute_vor(self.vel.to_numpy()[:self.nx, :self.ny], self._vor)
+                    # normalise in place instead of through Normalize's masked-array copy:
+                    # per frame only the vel copy and the colormap output are allocated
+                    self._vor -= self._vor_norm.vmin
+                    self._vor /= self._vor_norm.vmax - self._vor_norm.vmin
+                    img[:, :self.ny] = self._my_cmap(self._vor, bytes=True)
+                gui.set_image(img)
+
+                # gui.show()
+                gui.show(f'frame/{i:04d}.png')
 
             if (i % 1000 == 0):
                 print('Step: {:}'.format(i))
-                # ti.imwrite((img[:,:,0:3]*255).astype(np.uint8), 'fig/karman_'+str(i).zfill(6)+'.png')
+                # ti.imwrite(img[:,:,0:3], 'fig/karman_'+str(i).zfill(6)+'.png')
 
     def pass_to_py(self):
-        self.get_display_var_x()
-        return self.display_var.to_numpy()
+        # x-direction velocity component only (vel is padded to whole tiles)
+        return self.vel.to_numpy()[:self.nx, :self.ny, 0]
 
 
 if __name__ == '__main__':